@@ -1,4 +1,5 @@
-import duckdb
+import os
+import pyarrow.compute as pc
 import plotly.graph_objects as go
 import streamlit as st
 from datetime import datetime
@@ -8,52 +9,107 @@ from fertilizer_sql_analysis import (
     visualize_top_consumers_2020,
     visualize_trend_line_chart,
     peak_consumption_advanced_interactive,
-    consumption_change_analysis,
     world_map_with_timeslider,
     interactive_map_with_trends,
-    get_country_trend
+    get_country_trend,
+    change_table,
+    ensure_data,
+    get_connection,
+    PARQUET_PATH
 )
 
-DB_PATH = "fertilizer.duckdb"
+# Resource limits for the shared connection, sized to the deployment
+DUCKDB_THREADS = int(os.getenv("DUCKDB_THREADS", "4"))
+DUCKDB_MEMORY_LIMIT = os.getenv("DUCKDB_MEMORY_LIMIT", "1GB")
 
-# Add caching decorators for expensive operations
-@st.cache_data(ttl=3600)
-def cached_load_fertilizer_data():
+@st.cache_resource
+def configured_connection():
+    """Configure the analysis module's shared DuckDB connection once per process"""
+    con = get_connection()
+    con.execute(f"PRAGMA threads={DUCKDB_THREADS}")
+    con.execute(f"PRAGMA memory_limit='{DUCKDB_MEMORY_LIMIT}'")
+    con.execute("PRAGMA enable_object_cache")
+    return con
+
+def snapshot_version():
+    """Modification time of the Parquet snapshot, used to key the disk-persisted caches"""
+    return os.path.getmtime(PARQUET_PATH)
+
+# Add caching decorators for expensive operations; the base loaders persist to
+# disk (Streamlit ignores TTLs there), so they are keyed on the snapshot version
+# and a rebuild, in the app or from the CLI, invalidates them
+@st.cache_data(persist="disk")
+def cached_load_fertilizer_data(version):
     """Cache the data loading to avoid repeated database queries"""
-    con = duckdb.connect(DB_PATH)
-    df = con.execute("""
-        SELECT iso3, country_name, region, year, kg_per_ha
-        FROM wb.fertilizer_clean 
+    tbl = configured_connection().cursor().execute(f"""
+        SELECT iso3, country_name, region, year::SMALLINT AS year, kg_per_ha
+        FROM read_parquet('{PARQUET_PATH}')
+        WHERE kg_per_ha IS NOT NULL
+    """).fetch_arrow_table()
+    # Dictionary-encode the repeated string columns to shrink the cached table
+    for name in ('iso3', 'country_name', 'region'):
+        tbl = tbl.set_column(tbl.schema.get_field_index(name), name, pc.dictionary_encode(tbl[name]))
+    return tbl
+
+@st.cache_data(ttl=3600)
+def cached_overview_stats(year_lo, year_hi, region):
+    """Cache the overview KPIs, computed in a single DuckDB aggregate"""
+    stats = configured_connection().cursor().execute("""
+        SELECT
+            COUNT(DISTINCT country_name) AS countries,
+            AVG(kg_per_ha) AS avg_consumption,
+            MAX(kg_per_ha) AS max_consumption,
+            COUNT(*) AS data_points
+        FROM wb.fertilizer_clean
         WHERE kg_per_ha IS NOT NULL
-        ORDER BY year, country_name
-    """).df()
-    con.close()
-    return df
+          AND year BETWEEN ? AND ?
+          AND (? = 'All Regions' OR region = ?)
+    """, [year_lo, year_hi, region, region]).fetchone()
+    return stats
+
+@st.cache_data(persist="disk")
+def cached_dim_lists(version):
+    """Cache the sorted country and region lists, derived from the cached data"""
+    tbl = cached_load_fertilizer_data(version)
+    countries = sorted(pc.unique(tbl['country_name']).to_pylist())
+    regions = sorted(pc.unique(tbl['region'].drop_null()).to_pylist())
+    return countries, regions
+
+# Analysis results are memoized by their arguments: DataFrames go through
+# st.cache_data, results holding Plotly figures through st.cache_resource
+@st.cache_data(ttl=3600)
+def cached_top_consumers(top_n):
+    """Cache the top consumers table (an Arrow table, rendered as-is)"""
+    return visualize_top_consumers_2020(top_n=top_n)
+
+@st.cache_resource(ttl=3600)
+def cached_peak_consumption(top_n):
+    """Cache the peak consumption data and figure"""
+    return peak_consumption_advanced_interactive(top_n=top_n)
+
+@st.cache_data(ttl=3600)
+def cached_trend_data(countries, year_start, year_end):
+    """Cache the trend data for a set of countries"""
+    return visualize_trend_line_chart(countries=list(countries), year_start=year_start, year_end=year_end)
 
-@st.cache_data
-def cached_country_list():
-    """Cache the list of available countries"""
-    con = duckdb.connect(DB_PATH)
-    countries = con.execute("""
-        SELECT DISTINCT country_name 
-        FROM wb.fertilizer_clean 
-        ORDER BY country_name
-    """).df()['country_name'].tolist()
-    con.close()
-    return countries
+@st.cache_resource(ttl=3600)
+def cached_world_map():
+    """Cache the world map data and animated figure"""
+    return world_map_with_timeslider()
 
-@st.cache_data
-def cached_region_list():
-    """Cache the list of available regions"""
-    con = duckdb.connect(DB_PATH)
-    regions = con.execute("""
-        SELECT DISTINCT region 
-        FROM wb.fertilizer_clean 
-        WHERE region IS NOT NULL
-        ORDER BY region
-    """).df()['region'].tolist()
-    con.close()
-    return regions
+@st.cache_data(ttl=3600)
+def cached_change_analysis(year_start, year_end):
+    """Cache the consumption changes between two years, computed in one DuckDB pass"""
+    return change_table(year_start=year_start, year_end=year_end)
+
+@st.cache_resource(show_spinner="Downloading data from World Bank API...")
+def ensure_fertilizer_data():
+    """Build the database and Parquet snapshot on first start (once per process)"""
+    rebuilt = ensure_data()
+    if rebuilt:
+        # Cached results were computed from the previous data
+        st.cache_data.clear()
+    return rebuilt
 
 def initialize_session_state():
     """Initialize all session state variables"""
@@ -61,49 +117,30 @@ def initialize_session_state():
         st.session_state.selected_country = None
     if 'last_etl_run' not in st.session_state:
         st.session_state.last_etl_run = None
-    if 'cached_data' not in st.session_state:
-        st.session_state.cached_data = None
 
 def optimized_show_overview_dashboard(year_range, selected_region):
     """Optimized overview dashboard with cached data"""
     st.header("📊 Overview Dashboard")
     
-    # Load data with caching
-    if st.session_state.cached_data is None:
-        with st.spinner("Loading data..."):
-            st.session_state.cached_data = cached_load_fertilizer_data()
-    
-    df = st.session_state.cached_data
-    
-    # Filter data based on selections
-    filtered_df = df[
-        (df['year'] >= year_range[0]) & 
-        (df['year'] <= year_range[1])
-    ]
-    
-    if selected_region != "All Regions":
-        filtered_df = filtered_df[filtered_df['region'] == selected_region]
-    
-    # Key metrics
+    # Key metrics (filtered and aggregated in DuckDB, cached per combination)
+    total_countries, avg_consumption, max_consumption, data_points = cached_overview_stats(
+        year_range[0], year_range[1], selected_region
+    )
     col1, col2, col3, col4 = st.columns(4)
     with col1:
-        total_countries = filtered_df['country_name'].nunique()
         st.metric("Countries", total_countries)
     with col2:
-        avg_consumption = filtered_df['kg_per_ha'].mean()
-        st.metric("Avg Consumption", f"{avg_consumption:.0f} kg/ha")
+        st.metric("Avg Consumption", f"{avg_consumption:.0f} kg/ha" if avg_consumption is not None else "N/A")
     with col3:
-        max_consumption = filtered_df['kg_per_ha'].max()
-        st.metric("Peak Consumption", f"{max_consumption:.0f} kg/ha")
+        st.metric("Peak Consumption", f"{max_consumption:.0f} kg/ha" if max_consumption is not None else "N/A")
     with col4:
-        data_points = len(filtered_df)
         st.metric("Data Points", f"{data_points:,}")
     
     # Use your existing function for top consumers
     st.subheader("Top Fertilizer Consumers (Latest Data)")
-    top_df = visualize_top_consumers_2020(top_n=15)
+    top_tbl = cached_top_consumers(top_n=15)
     st.dataframe(
-        top_df,
+        top_tbl,
         use_container_width=True,
         hide_index=True,
         column_config={
@@ -115,14 +152,14 @@ def optimized_show_overview_dashboard(year_range, selected_region):
     
     # Peak consumption interactive chart
     st.subheader("Peak Consumption Analysis")
-    peak_df, peak_fig = peak_consumption_advanced_interactive(top_n=20)
+    peak_df, peak_fig = cached_peak_consumption(top_n=20)
     st.plotly_chart(peak_fig, use_container_width=True)
 
 def show_country_trends(year_range, selected_region):
     st.header("📈 Country Trend Analysis")
     
     # Country selector with cached list
-    available_countries = cached_country_list()
+    available_countries, _ = cached_dim_lists(snapshot_version())
     
     selected_countries = st.multiselect(
         "Select Countries to Compare",
@@ -133,8 +170,8 @@ def show_country_trends(year_range, selected_region):
     
     if selected_countries:
         # Use your existing trend function
-        trend_df = visualize_trend_line_chart(
-            countries=selected_countries,
+        trend_df = cached_trend_data(
+            countries=tuple(selected_countries),
             year_start=year_range[0],
             year_end=year_range[1]
         )
@@ -142,10 +179,15 @@ def show_country_trends(year_range, selected_region):
         # Country comparison metrics
         st.subheader("Country Comparison")
         cols = st.columns(len(selected_countries))
+        latest_by_country = (
+            trend_df.sort_values('year')
+            .groupby('country_name', sort=False)
+            .tail(1)
+            .set_index('country_name')['kg_per_ha']
+        )
         for idx, country in enumerate(selected_countries):
-            country_data = trend_df[trend_df['country_name'] == country]
-            if not country_data.empty:
-                latest = country_data[country_data['year'] == country_data['year'].max()]['kg_per_ha'].iloc[0]
+            latest = latest_by_country.get(country)
+            if latest is not None:
                 with cols[idx]:
                     st.metric(country, f"{latest:,.0f} kg/ha")
 
@@ -154,24 +196,23 @@ def show_world_map(year_range, selected_region):
     
     # Use your existing world map function
     st.info("Interactive world map with time slider - use the play button to see trends over time")
-    map_df, map_fig = world_map_with_timeslider()
+    map_df, map_fig = cached_world_map()
     st.plotly_chart(map_fig, use_container_width=True)
     
     # Map statistics
     st.subheader("Global Statistics")
+    country_count = map_df['iso3'].nunique()
     col1, col2, col3 = st.columns(3)
     with col1:
-        st.metric("Countries with Data", f"{len(map_df['iso3'].unique()):,}")
-    with col2:
-        if not map_df.empty:
-            latest_year = map_df['year'].max()
-            latest_data = map_df[map_df['year'] == latest_year]
-            if not latest_data.empty:
-                max_country = latest_data.nlargest(1, 'kg_per_ha')['country_name'].iloc[0]
-                st.metric("Highest Consumer", max_country)
-    with col3:
-        if not map_df.empty:
-            st.metric("Global Average", f"{map_df['kg_per_ha'].mean():.0f} kg/ha")
+        st.metric("Countries with Data", f"{country_count:,}")
+    if not map_df.empty:
+        global_average = map_df['kg_per_ha'].mean()
+        latest_data = map_df[map_df['year'] == map_df['year'].max()]
+        with col2:
+            max_country = latest_data.loc[latest_data['kg_per_ha'].idxmax(), 'country_name']
+            st.metric("Highest Consumer", max_country)
+        with col3:
+            st.metric("Global Average", f"{global_average:.0f} kg/ha")
 
 def enhanced_change_analysis(year_range, selected_region):
     """Enhanced change analysis with interactive controls"""
@@ -190,8 +231,7 @@ def enhanced_change_analysis(year_range, selected_region):
     
     if st.button("🔍 Analyze Changes", type="primary"):
         with st.spinner("Calculating consumption changes..."):
-            # Use your existing change analysis function
-            change_df = consumption_change_analysis(
+            change_df = cached_change_analysis(
                 year_start=change_start,
                 year_end=change_end
             )
@@ -208,34 +248,45 @@ def display_change_analysis_results(change_df, start_year, end_year):
         st.warning("No data matches your criteria")
         return
     
-    # Top increases and decreases
+    # Top increases and decreases, each rendered as a single table
+    columns = ['country_name', 'region', 'absolute_change', 'percent_change']
+    increases = change_df[change_df['absolute_change'] > 0].nlargest(10, 'absolute_change')[columns]
+    decreases = change_df[change_df['absolute_change'] < 0].nsmallest(10, 'absolute_change')[columns]
+    decreases = decreases.assign(percent_change=decreases['percent_change'].abs())
+    
     col1, col2 = st.columns(2)
     
     with col1:
         st.subheader("📈 Largest Increases")
-        increases = change_df[change_df['absolute_change'] > 0].head(10)
-        for idx, row in increases.iterrows():
-            with st.container():
-                col_a, col_b = st.columns([2, 1])
-                with col_a:
-                    st.write(f"**{row['country_name']}**")
-                    st.caption(f"{row['region']}")
-                with col_b:
-                    st.metric("", f"+{row['absolute_change']:.0f}", delta=f"+{row['percent_change']:.1f}%")
-                st.progress(min(row['percent_change'] / 100, 1.0))
+        st.dataframe(
+            increases,
+            use_container_width=True,
+            hide_index=True,
+            column_config={
+                "country_name": "Country",
+                "region": "Region",
+                "absolute_change": st.column_config.NumberColumn("Change (kg/ha)", format="+%d"),
+                "percent_change": st.column_config.ProgressColumn(
+                    "Increase (%)", format="+%.1f%%", min_value=0, max_value=100
+                )
+            }
+        )
     
     with col2:
         st.subheader("📉 Largest Decreases")
-        decreases = change_df[change_df['absolute_change'] < 0].head(10)
-        for idx, row in decreases.iterrows():
-            with st.container():
-                col_a, col_b = st.columns([2, 1])
-                with col_a:
-                    st.write(f"**{row['country_name']}**")
-                    st.caption(f"{row['region']}")
-                with col_b:
-                    st.metric("", f"{row['absolute_change']:.0f}", delta=f"{row['percent_change']:.1f}%")
-                st.progress(min(abs(row['percent_change']) / 100, 1.0))
+        st.dataframe(
+            decreases,
+            use_container_width=True,
+            hide_index=True,
+            column_config={
+                "country_name": "Country",
+                "region": "Region",
+                "absolute_change": st.column_config.NumberColumn("Change (kg/ha)", format="%d"),
+                "percent_change": st.column_config.ProgressColumn(
+                    "Decrease (%)", format="-%.1f%%", min_value=0, max_value=100
+                )
+            }
+        )
 
 def optimized_data_management():
     """Enhanced data management with progress tracking"""
@@ -243,8 +294,7 @@ def optimized_data_management():
     
     # Database status
     st.subheader("Database Status")
-    con = duckdb.connect(DB_PATH)
-    stats = con.execute("""
+    stats = configured_connection().cursor().execute("""
         SELECT 
             COUNT(*) as total_records,
             MIN(year) as first_year,
@@ -253,7 +303,6 @@ def optimized_data_management():
             COUNT(DISTINCT region) as regions
         FROM wb.fertilizer_clean
     """).fetchone()
-    con.close()
     
     col1, col2, col3, col4 = st.columns(4)
     col1.metric("Total Records", f"{stats[0]:,}")
@@ -272,7 +321,8 @@ def optimized_data_management():
                     load_api_to_duckdb()
                     clean_with_sql()
                     st.session_state.last_etl_run = datetime.now()
-                    st.session_state.cached_data = None  # Clear cache
+                    st.cache_data.clear()  # Includes the disk-persisted loaders
+                    st.cache_resource.clear()
                     st.success("✅ ETL pipeline completed successfully!")
                     st.rerun()
                 except Exception as e:
@@ -280,8 +330,8 @@ def optimized_data_management():
     
     with col2:
         if st.button("🗑️ Clear Cache", use_container_width=True):
-            st.session_state.cached_data = None
             st.cache_data.clear()
+            st.cache_resource.clear()
             st.success("✅ Cache cleared!")
     
     # Last ETL run info
@@ -298,9 +348,8 @@ def add_footer():
     with col2:
         st.caption(f"Last update: {datetime.now().strftime('%Y-%m-%d')}")
     with col3:
-        if st.session_state.cached_data is not None:
-            record_count = len(st.session_state.cached_data)
-            st.caption(f"📊 {record_count:,} records loaded")
+        record_count = cached_load_fertilizer_data(snapshot_version()).num_rows
+        st.caption(f"📊 {record_count:,} records loaded")
 
 def main():
     st.set_page_config(
@@ -312,6 +361,7 @@ def main():
     
     # Initialize session state
     initialize_session_state()
+    ensure_fertilizer_data()
     
     st.title("🌍 Global Fertilizer Consumption Analysis")
     st.markdown("Analyzing fertilizer use patterns across countries and time")
@@ -341,14 +391,14 @@ def main():
     )
     
     # Use cached region list
-    all_regions = ["All Regions"] + cached_region_list()
+    _, regions = cached_dim_lists(snapshot_version())
+    all_regions = ["All Regions"] + regions
     selected_region = st.sidebar.selectbox("Filter by Region", all_regions)
     
     # Performance info
     st.sidebar.markdown("---")
     st.sidebar.caption("⚡ Performance Optimized")
-    if st.session_state.cached_data is not None:
-        st.sidebar.caption(f"📁 {len(st.session_state.cached_data):,} records cached")
+    st.sidebar.caption(f"📁 {cached_load_fertilizer_data(snapshot_version()).num_rows:,} records cached")
     
     # Route to appropriate function
     if app_mode == "📊 Overview Dashboard":
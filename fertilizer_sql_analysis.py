@@ -1,5 +1,14 @@
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from pathlib import Path
+import tempfile
+import numpy as np
 import pandas as pd
+import pyarrow as pa
 import duckdb
 import matplotlib.pyplot as plt
 from plotly.graph_objects import Figure
@@ -10,64 +19,258 @@ from plotly.subplots import make_subplots
 WB_URL = "https://api.worldbank.org/v2"
 WB_INDICATOR = "AG.CON.FERT.ZS"  # fertilizer consumption (kg/ha of arable land)
 DB_PATH = "fertilizer.duckdb"
+WB_PER_PAGE = 1000  # largest page size the API serves
+ETL_WORKERS = 16  # concurrent World Bank API requests
+PARQUET_PATH = "fertilizer_clean.parquet"  # read-only snapshot of wb.fertilizer_clean
 
+# Fields DuckDB extracts from each indicator record for wb.raw_fert
+FERT_RECORD_STRUCTURE = (
+    '{"countryiso3code": "VARCHAR", "country": {"id": "VARCHAR", "value": "VARCHAR"}, '
+    '"date": "VARCHAR", "value": "DOUBLE"}'
+)
 
-def load_api_to_duckdb(db_path: str = DB_PATH):
-    """Load World Bank fertilizer and country data into DuckDB raw tables."""
-    
-    # Fetch fertilizer indicator data (all countries, all years)
-    fert = []
-    page = 1
-    while True:
-        r = requests.get(
-            f"{WB_URL}/country/ALL/indicator/{WB_INDICATOR}",
-            params={"format": "json", "per_page": 50, "page": page},
-            timeout=60,
-        )
-        r.raise_for_status()
-        payload = r.json()
-        if not isinstance(payload, list) or len(payload) < 2 or not payload[1]:
-            break
-        fert.extend(payload[1])
-        if page >= payload[0]["pages"]:
-            break
-        page += 1
-    df_f = pd.json_normalize(fert)
-
-    # Fetch country master data
-    r = requests.get(
+# Columns of the country master data for wb.raw_country
+COUNTRY_SCHEMA = pa.schema([
+    ("iso3", pa.string()),
+    ("iso2", pa.string()),
+    ("name", pa.string()),
+    ("region", pa.string()),
+])
+
+
+# Parameterized read queries, kept as module constants so every call ships the
+# same SQL text over the shared connection
+_TOP_CONSUMERS_SQL = """
+SELECT 
+    country_name,
+    region,
+    kg_per_ha
+FROM wb.fertilizer_clean
+WHERE year = 2020
+ORDER BY kg_per_ha DESC
+LIMIT ?
+"""
+
+_TREND_SQL = """
+SELECT 
+    country_name,
+    MIN(year) AS year,
+    AVG(kg_per_ha) AS kg_per_ha
+FROM wb.fertilizer_clean
+WHERE list_contains(?, country_name)
+    AND year BETWEEN ? AND ?
+GROUP BY country_name, (year - ?) // ?
+ORDER BY country_name, year
+"""
+
+_PEAKS_SQL = """
+SELECT *, 
+       CASE WHEN peak_consumption > 500 THEN 'Very High'
+            WHEN peak_consumption > 200 THEN 'High'
+            WHEN peak_consumption > 100 THEN 'Medium'
+            ELSE 'Low' END as consumption_level
+FROM wb.fertilizer_peaks
+ORDER BY peak_consumption DESC LIMIT ?
+"""
+
+_CHANGES_SQL = """
+WITH changes AS (
+    SELECT 
+        country_name,
+        region,
+        MAX(kg_per_ha) FILTER (WHERE year = ?) as start_consumption,
+        MAX(kg_per_ha) FILTER (WHERE year = ?) as end_consumption
+    FROM wb.fertilizer_clean
+    WHERE year IN (?, ?)
+    GROUP BY country_name, region
+    HAVING COUNT(DISTINCT year) = 2  -- Only countries with data for both years
+)
+SELECT *,
+       end_consumption - start_consumption as absolute_change,
+       ROUND((end_consumption - start_consumption) * 100.0 / NULLIF(start_consumption, 0), 1) as percent_change
+FROM changes
+WHERE start_consumption IS NOT NULL AND end_consumption IS NOT NULL
+ORDER BY absolute_change DESC
+"""
+
+_MAP_SQL = """
+SELECT 
+    iso3,
+    country_name, 
+    region,
+    year,
+    kg_per_ha
+FROM wb.fertilizer_clean
+WHERE year >= 1990 AND kg_per_ha IS NOT NULL
+ORDER BY year, kg_per_ha DESC
+"""
+
+_COUNTRY_TREND_BY_ISO3_SQL = """
+SELECT 
+    country_name,
+    year,
+    kg_per_ha,
+    region
+FROM wb.fertilizer_clean
+WHERE iso3 = ? AND kg_per_ha IS NOT NULL
+ORDER BY year
+"""
+
+_COUNTRY_TREND_BY_NAME_SQL = """
+SELECT 
+    country_name,
+    year,
+    kg_per_ha,
+    region
+FROM wb.fertilizer_clean
+WHERE country_name = ? AND kg_per_ha IS NOT NULL
+ORDER BY year
+"""
+
+
+@lru_cache(maxsize=None)
+def _open_connection(db_file: str):
+    """Open the DuckDB connection for a canonical database path (cached per path)."""
+    return duckdb.connect(db_file)
+
+
+def get_connection(db_path: str = DB_PATH):
+    """Return the shared DuckDB connection for db_path, opened once per process."""
+    # Resolve the path so "fertilizer.duckdb", "./fertilizer.duckdb" and the
+    # default argument all map to the same cached connection
+    return _open_connection(db_path if db_path == ":memory:" else str(Path(db_path).resolve()))
+
+
+def _cursor(db_path: str = DB_PATH):
+    """Return a cursor on the shared connection (safe to use from any thread)."""
+    return get_connection(db_path).cursor()
+
+
+def _api_session(pool_size: int = ETL_WORKERS) -> requests.Session:
+    """Create an HTTP session with pooled keep-alive connections and retries."""
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        max_retries=Retry(total=3, backoff_factor=0.3),
+    )
+    session.mount("https://", adapter)
+    session.headers.update({"Accept": "application/json"})
+    return session
+
+
+def _fetch_fert_page(session: requests.Session, page: int) -> bytes:
+    """Fetch one page of the fertilizer indicator (all countries, all years) as raw JSON."""
+    r = session.get(
+        f"{WB_URL}/country/ALL/indicator/{WB_INDICATOR}",
+        params={"format": "json", "per_page": WB_PER_PAGE, "page": page},
+        timeout=60,
+    )
+    r.raise_for_status()
+    return r.content
+
+
+def _fetch_countries(session: requests.Session):
+    """Fetch the World Bank country master data records."""
+    r = session.get(
         f"{WB_URL}/country",
         params={"format": "json", "per_page": 20000},
         timeout=60
     )
     r.raise_for_status()
-    payload = r.json()
-    rows = payload[1] if isinstance(payload, list) and len(payload) > 1 else []
-    
-    # Create tidy country dataframe
-    df_c = pd.DataFrame([{
-        "iso3": rec["id"],
-        "iso2": rec["iso2Code"],
-        "name": rec["name"],
-        "region": (rec.get("region") or {}).get("value")
-    } for rec in rows])
-
-    # Save to DuckDB
-    con = duckdb.connect(db_path)
-    con.execute("CREATE SCHEMA IF NOT EXISTS wb;")
-    con.register("df_f", df_f)
-    con.register("df_c", df_c)
-    con.execute("CREATE OR REPLACE TABLE wb.raw_fert AS SELECT * FROM df_f;")
-    con.execute("CREATE OR REPLACE TABLE wb.raw_country AS SELECT * FROM df_c;")
-    con.close()
+    payload = orjson.loads(r.content)
+    return payload[1] if isinstance(payload, list) and len(payload) > 1 else []
+
+
+def _page_records(payload):
+    """Return the records of an API page, or an empty list for an empty page."""
+    if not isinstance(payload, list) or len(payload) < 2 or not payload[1]:
+        return []
+    return payload[1]
+
+
+def _write_page(page_dir: str, page: int, content: bytes):
+    """Write one raw API page where DuckDB's JSON reader will pick it up."""
+    Path(page_dir, f"wb_page_{page:05d}.json").write_bytes(content)
+
+
+def load_api_to_duckdb(db_path: str = DB_PATH, max_workers: int = ETL_WORKERS):
+    """Load World Bank fertilizer and country data into DuckDB raw tables."""
+    
+    session = _api_session(max_workers)
+    with tempfile.TemporaryDirectory(prefix="wb_fert_") as page_dir:
+        with session, ThreadPoolExecutor(max_workers=max_workers) as pool:
+            # Country master data does not depend on the indicator pages
+            countries_future = pool.submit(_fetch_countries, session)
+            
+            # Only the first page is decoded in Python, to learn the page count;
+            # every page is written to disk as-is for DuckDB to parse
+            first = _fetch_fert_page(session, 1)
+            _write_page(page_dir, 1, first)
+            payload = orjson.loads(first)
+            if _page_records(payload):
+                pages = range(2, payload[0]["pages"] + 1)
+                contents = pool.map(lambda page: _fetch_fert_page(session, page), pages)
+                for page, content in zip(pages, contents):
+                    _write_page(page_dir, page, content)
+            
+            rows = countries_future.result()
+        
+        # Create tidy country table, one list per column
+        iso3, iso2, name, region = [], [], [], []
+        for rec in rows:
+            iso3.append(rec["id"])
+            iso2.append(rec["iso2Code"])
+            name.append(rec["name"])
+            region.append((rec.get("region") or {}).get("value"))
+        tbl_c = pa.table([iso3, iso2, name, region], schema=COUNTRY_SCHEMA)
+        
+        # Save to DuckDB
+        con = _cursor(db_path)
+        con.execute("CREATE SCHEMA IF NOT EXISTS wb;")
+        con.execute("""
+        CREATE OR REPLACE TABLE wb.raw_fert (
+            countryiso3code VARCHAR,
+            "country.id" VARCHAR,
+            "country.value" VARCHAR,
+            date VARCHAR,
+            value DOUBLE
+        );
+        """)
+        con.execute("""
+        CREATE OR REPLACE TABLE wb.raw_country (
+            iso3 VARCHAR,
+            iso2 VARCHAR,
+            name VARCHAR,
+            region VARCHAR
+        );
+        """)
+        # Each page file is one [metadata, records] document; DuckDB parses the
+        # records array straight into typed columns
+        page_glob = Path(page_dir, "wb_page_*.json").as_posix()
+        con.execute(f"""
+        INSERT INTO wb.raw_fert
+        SELECT
+            rec.countryiso3code,
+            rec.country.id,
+            rec.country.value,
+            rec.date,
+            rec.value
+        FROM (
+            SELECT unnest(json_transform(json -> '$[1]', '[{FERT_RECORD_STRUCTURE}]')) AS rec
+            FROM read_json_objects('{page_glob}', format = 'unstructured')
+        );
+        """)
+        # DuckDB scans the local Arrow table in place (replacement scan)
+        con.execute("INSERT INTO wb.raw_country SELECT * FROM tbl_c;")
     
     print(f"✓ Loaded raw data to {db_path}")
 
 
-def clean_with_sql(db_path: str = DB_PATH):
-    """Clean and join fertilizer and country data into a final table."""
+def clean_with_sql(db_path: str = DB_PATH, parquet_path: str = PARQUET_PATH):
+    """Clean and join fertilizer and country data into final tables and a Parquet snapshot."""
     
-    con = duckdb.connect(db_path)
+    con = _cursor(db_path)
     con.execute("""
     CREATE OR REPLACE TABLE wb.fertilizer_clean AS
     WITH fert AS (
@@ -92,55 +295,78 @@ def clean_with_sql(db_path: str = DB_PATH):
         f.year,
         CAST(ROUND(f.kg_per_ha) AS INTEGER) AS kg_per_ha
     FROM fert f
-    JOIN countries c USING (iso3);
+    JOIN countries c USING (iso3)
+    ORDER BY f.year, c.region, country_name;  -- clustered by year; lets zonemaps skip row groups on year filters once the table outgrows one
+    """)
+    
+    # Pre-aggregate each country's peak year so the peak analysis is a lookup
+    con.execute("""
+    CREATE OR REPLACE TABLE wb.fertilizer_peaks AS
+    SELECT
+        country_name,
+        ANY_VALUE(region) AS region,
+        ARG_MAX(year, kg_per_ha) AS peak_year,
+        MAX(kg_per_ha) AS peak_consumption
+    FROM wb.fertilizer_clean
+    WHERE year >= 1970
+    GROUP BY country_name;
+    """)
+    
+    # Columnar snapshot for the app's read path
+    con.execute(f"""
+    COPY (SELECT * FROM wb.fertilizer_clean)
+    TO '{parquet_path}' (FORMAT PARQUET, COMPRESSION ZSTD);
     """)
-    con.close()
     
     print(f"✓ Created clean table in {db_path}")
+    print(f"✓ Wrote Parquet snapshot to {parquet_path}")
 
 
 def verify_data(db_path: str = DB_PATH):
     """Verify the cleaned data."""
     
-    con = duckdb.connect(db_path)
+    con = _cursor(db_path)
     
-    # Row count
-    count = con.execute("SELECT COUNT(*) FROM wb.fertilizer_clean").fetchone()[0]
+    # Row count, year range and a sample in a single round-trip
+    count, min_year, max_year, sample = con.execute("""
+    WITH stats AS (
+        SELECT COUNT(*) AS total_rows, MIN(year) AS min_year, MAX(year) AS max_year
+        FROM wb.fertilizer_clean
+    )
+    SELECT
+        total_rows,
+        min_year,
+        max_year,
+        (SELECT list(s) FROM (SELECT * FROM wb.fertilizer_clean LIMIT 5) s) AS sample
+    FROM stats
+    """).fetchone()
     print(f"\nTotal rows: {count:,}")
-    
-    # Year range
-    min_year, max_year = con.execute(
-        "SELECT MIN(year), MAX(year) FROM wb.fertilizer_clean"
-    ).fetchone()
     print(f"Year range: {min_year} - {max_year}")
     
     # Sample data
     print("\nSample data:")
-    print(con.execute("SELECT * FROM wb.fertilizer_clean LIMIT 5").df())
-    
-    con.close()
+    print(pd.DataFrame(sample or []))
+
 
-load_api_to_duckdb()
-clean_with_sql()
-verify_data()
+def ensure_data(db_path: str = DB_PATH, parquet_path: str = PARQUET_PATH):
+    """Run the ETL pipeline only if the Parquet snapshot does not exist yet."""
+    
+    if Path(parquet_path).exists():
+        return False
+    load_api_to_duckdb(db_path)
+    clean_with_sql(db_path, parquet_path)
+    return True
 
 def visualize_top_consumers_2020(db_path: str = DB_PATH, top_n: int = 20):
-    """Show countries with highest fertilizer consumption in 2020."""
+    """Show countries with highest fertilizer consumption in 2020.
     
-    con = duckdb.connect(db_path)
+    Returns a pyarrow Table, which Streamlit can render without a pandas copy;
+    call .to_pandas() on it when a DataFrame is needed.
+    """
     
-    df = con.execute(f"""
-    SELECT 
-        country_name,
-        region,
-        kg_per_ha
-    FROM wb.fertilizer_clean
-    WHERE year = 2020
-    ORDER BY kg_per_ha DESC
-    LIMIT {top_n}
-    """).df()
+    con = _cursor(db_path)
     
-    con.close()
+    tbl = con.execute(_TOP_CONSUMERS_SQL, [top_n]).fetch_arrow_table()
     
     # Display the table
     print(f"\n{'='*70}")
@@ -151,25 +377,26 @@ def visualize_top_consumers_2020(db_path: str = DB_PATH, top_n: int = 20):
     print(f"{'Rank':<6} {'Country':<30} {'Region':<25} {'kg/ha':>8}")
     print(f"{'-'*6} {'-'*30} {'-'*25} {'-'*8}")
     
-    for idx, row in df.iterrows():
-        rank = idx + 1
-        country = row['country_name'][:28]  # Truncate long names
-        region = row['region'][:23] if row['region'] else 'N/A'
-        kg = row['kg_per_ha']
+    # Walk the Arrow columns as plain tuples; no per-row dicts or pandas
+    rows = zip(*(tbl.column(name).to_pylist() for name in ('country_name', 'region', 'kg_per_ha')))
+    for rank, (country, region, kg) in enumerate(rows, 1):
+        country = country[:28]  # Truncate long names
+        region = region[:23] if region else 'N/A'
         print(f"{rank:<6} {country:<30} {region:<25} {kg:>8,}")
     
     print(f"\n{'='*70}\n")
     
-    return df
+    return tbl
 
 
 # Show visualization
 # df_top = visualize_top_consumers_2020(top_n=20)
     
     # Optional: Access the dataframe for further analysis
-    # print(df_top.describe())
+    # print(df_top.to_pandas().describe())
 
-def visualize_trend_line_chart(db_path: str = DB_PATH, countries: list = None, year_start: int = 1990, year_end: int = 2023):
+def visualize_trend_line_chart(db_path: str = DB_PATH, countries: list = None, year_start: int = 1990, year_end: int = 2023,
+                               max_points: int = 200):
     """Create a line chart showing fertilizer consumption trends over time.
     
     Args:
@@ -177,9 +404,10 @@ def visualize_trend_line_chart(db_path: str = DB_PATH, countries: list = None, y
         countries: List of country names to plot. If None, shows top 10 consumers in latest year
         year_start: Start year for the chart
         year_end: End year for the chart
+        max_points: Maximum points per country; longer ranges are averaged into year buckets in SQL
     """
 
-    con = duckdb.connect(db_path)
+    con = _cursor(db_path)
     
     # If no countries specified, get top 10 from most recent year with data
     if countries is None:
@@ -189,23 +417,13 @@ def visualize_trend_line_chart(db_path: str = DB_PATH, countries: list = None, y
         WHERE year = (SELECT MAX(year) FROM wb.fertilizer_clean WHERE kg_per_ha IS NOT NULL)
         ORDER BY kg_per_ha DESC
         LIMIT 10
-        """).df()
-        countries = top_countries['country_name'].tolist()
-    
-    # Fetch data for selected countries
-    country_list = "','".join(countries)
-    df = con.execute(f"""
-    SELECT 
-        country_name,
-        year,
-        kg_per_ha
-    FROM wb.fertilizer_clean
-    WHERE country_name IN ('{country_list}')
-        AND year BETWEEN {year_start} AND {year_end}
-    ORDER BY country_name, year
-    """).df()
+        """).fetchall()
+        countries = [name for (name,) in top_countries]
     
-    con.close()
+    # Fetch data for selected countries (bound as a LIST parameter), downsampled
+    # in DuckDB to at most max_points buckets per country
+    bucket_years = max(-(-(year_end - year_start + 1) // max_points), 1)
+    df = con.execute(_TREND_SQL, [list(countries), year_start, year_end, year_start, bucket_years]).df()
     
     # Create the plot
     plt.figure(figsize=(14, 8))
@@ -213,7 +431,8 @@ def visualize_trend_line_chart(db_path: str = DB_PATH, countries: list = None, y
     # Plot each country
     for country in countries:
         country_data = df[df['country_name'] == country]
-        plt.plot(country_data['year'], country_data['kg_per_ha'], 
+        # Plain integer years keep matplotlib on its numeric tick formatter
+        plt.plot(country_data['year'].to_numpy(np.int32), country_data['kg_per_ha'].to_numpy(), 
                 marker='o', markersize=3, linewidth=2, label=country)
     
     # Styling
@@ -237,22 +456,8 @@ def visualize_trend_line_chart(db_path: str = DB_PATH, countries: list = None, y
 def peak_consumption_advanced_interactive(db_path: str = DB_PATH, top_n: int = 20):
     """More advanced interactive version with custom selection behavior."""
     
-    con = duckdb.connect(db_path)
-    df = con.execute("""
-    WITH ranked AS (
-        SELECT country_name, region, year as peak_year, kg_per_ha as peak_consumption,
-               ROW_NUMBER() OVER (PARTITION BY country_name ORDER BY kg_per_ha DESC) as rank
-        FROM wb.fertilizer_clean WHERE year >= 1970
-    )
-    SELECT *, 
-           CASE WHEN peak_consumption > 500 THEN 'Very High'
-                WHEN peak_consumption > 200 THEN 'High'
-                WHEN peak_consumption > 100 THEN 'Medium'
-                ELSE 'Low' END as consumption_level
-    FROM ranked WHERE rank = 1
-    ORDER BY peak_consumption DESC LIMIT ?
-    """, [top_n]).df()
-    con.close()
+    con = _cursor(db_path)
+    df = con.execute(_PEAKS_SQL, [top_n]).df()
     
     fig = px.bar(
         df, x='peak_consumption', y='country_name',
@@ -276,26 +481,19 @@ def peak_consumption_advanced_interactive(db_path: str = DB_PATH, top_n: int = 2
 #     """Advanced interactive heatmap with annotations and trends."""
     
 #     con = duckdb.connect(db_path)
+#     # One aggregate scan; avg_consumption already is the exact per-decade average
 #     df = con.execute("""
-#     WITH region_data AS (
-#         SELECT 
-#             region,
-#             FLOOR(year/10)*10 as decade,
-#             AVG(kg_per_ha) as avg_consumption,
-#             COUNT(*) as country_count,
-#             MIN(kg_per_ha) as min_consumption,
-#             MAX(kg_per_ha) as max_consumption
-#         FROM wb.fertilizer_clean
-#         WHERE year >= 1990
-#         GROUP BY region, decade
-#         HAVING COUNT(*) > 5
-#     )
-#     SELECT *,
-#            (SELECT AVG(kg_per_ha) 
-#             FROM wb.fertilizer_clean f2 
-#             WHERE f2.region = region_data.region 
-#             AND f2.year BETWEEN region_data.decade AND region_data.decade+9) as exact_avg
-#     FROM region_data
+#     SELECT 
+#         region,
+#         FLOOR(year/10)*10 as decade,
+#         AVG(kg_per_ha) as avg_consumption,
+#         COUNT(*) as country_count,
+#         MIN(kg_per_ha) as min_consumption,
+#         MAX(kg_per_ha) as max_consumption
+#     FROM wb.fertilizer_clean
+#     WHERE year >= 1990
+#     GROUP BY region, decade
+#     HAVING COUNT(*) > 5
 #     ORDER BY decade, region
 #     """).df()
 #     con.close()
@@ -355,44 +553,42 @@ def peak_consumption_advanced_interactive(db_path: str = DB_PATH, top_n: int = 2
 # # Execute advanced version
 # advanced_df, advanced_fig = regional_heatmap_advanced()
 
+def _format_change_rows(rows: pd.DataFrame) -> str:
+    """Format change rows as fixed-width text lines under the report header."""
+    
+    if rows.empty:
+        return ""
+    table = pd.DataFrame({
+        "rank": range(1, len(rows) + 1),
+        "country": rows['country_name'].str.slice(0, 24),
+        "region": rows['region'].fillna('N/A').str.slice(0, 19),
+        "start": rows['start_consumption'],
+        "end": rows['end_consumption'],
+        "change": rows['absolute_change'],
+        "percent": rows['percent_change'],
+    })
+    return table.to_string(
+        index=False,
+        header=False,
+        formatters={
+            "rank": "{:<6}".format,
+            "country": "{:<25}".format,
+            "region": "{:<20}".format,
+            "start": "{:>8,}".format,
+            "end": "{:>8,}".format,
+            "change": "{:>+8,}".format,
+            "percent": "{:>+9}%".format,
+        },
+    )
+
+def change_table(db_path: str = DB_PATH, year_start: int = 2010, year_end: int = 2020):
+    """Return per-country consumption changes between two years, largest increase first."""
+    return _cursor(db_path).execute(_CHANGES_SQL, [year_start, year_end, year_start, year_end]).df()
+
 def consumption_change_analysis(db_path: str = DB_PATH, year_start: int = 2010, year_end: int = 2020):
     """Analyze countries with largest consumption increases/decreases in the last decade."""
     
-    con = duckdb.connect(db_path)
-    
-    df = con.execute("""
-    WITH latest_data AS (
-        SELECT 
-            country_name,
-            region,
-            year,
-            kg_per_ha,
-            LAG(kg_per_ha) OVER (PARTITION BY country_name ORDER BY year) as prev_kg_per_ha
-        FROM wb.fertilizer_clean
-        WHERE year IN (?, ?)
-    ),
-    changes AS (
-        SELECT 
-            country_name,
-            region,
-            MAX(CASE WHEN year = ? THEN kg_per_ha END) as start_consumption,
-            MAX(CASE WHEN year = ? THEN kg_per_ha END) as end_consumption,
-            (MAX(CASE WHEN year = ? THEN kg_per_ha END) - 
-             MAX(CASE WHEN year = ? THEN kg_per_ha END)) as absolute_change,
-            ROUND(((MAX(CASE WHEN year = ? THEN kg_per_ha END) - 
-                   MAX(CASE WHEN year = ? THEN kg_per_ha END)) / 
-                   NULLIF(MAX(CASE WHEN year = ? THEN kg_per_ha END), 0)) * 100, 1) as percent_change
-        FROM latest_data
-        GROUP BY country_name, region
-        HAVING COUNT(DISTINCT year) = 2  -- Only countries with data for both years
-    )
-    SELECT *
-    FROM changes
-    WHERE start_consumption IS NOT NULL AND end_consumption IS NOT NULL
-    ORDER BY absolute_change DESC
-    """, [year_start, year_end, year_start, year_end, year_end, year_start, year_end, year_start, year_start]).df()
-    
-    con.close()
+    df = change_table(db_path, year_start, year_end)
     
     # Display results
     print(f"\n{'='*80}")
@@ -404,22 +600,14 @@ def consumption_change_analysis(db_path: str = DB_PATH, year_start: int = 2010,
     print(f"{'-'*6} {'-'*25} {'-'*20} {'-'*8} {'-'*8} {'-'*8} {'-'*10}")
     
     increases = df[df['absolute_change'] > 0].head(10)
-    for idx, row in increases.iterrows():
-        rank = idx + 1
-        print(f"{rank:<6} {row['country_name'][:24]:<25} {row['region'][:19]:<20} "
-              f"{row['start_consumption']:>8,} {row['end_consumption']:>8,} "
-              f"{row['absolute_change']:>+8,} {row['percent_change']:>+9}%")
+    print(_format_change_rows(increases))
     
     print(f"\n📉 TOP 10 DECREASES:")
     print(f"{'Rank':<6} {'Country':<25} {'Region':<20} {'Start':>8} {'End':>8} {'Change':>8} {'% Change':>10}")
     print(f"{'-'*6} {'-'*25} {'-'*20} {'-'*8} {'-'*8} {'-'*8} {'-'*10}")
     
     decreases = df[df['absolute_change'] < 0].head(10)
-    for idx, row in decreases.iterrows():
-        rank = idx + 1
-        print(f"{rank:<6} {row['country_name'][:24]:<25} {row['region'][:19]:<20} "
-              f"{row['start_consumption']:>8,} {row['end_consumption']:>8,} "
-              f"{row['absolute_change']:>+8,} {row['percent_change']:>+9}%")
+    print(_format_change_rows(decreases))
     
     # Create visualization
     fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(16, 6))
@@ -448,50 +636,98 @@ def consumption_change_analysis(db_path: str = DB_PATH, year_start: int = 2010,
 # Execute the change analysis
 # change_df = consumption_change_analysis(year_start=2010, year_end=2020)
 
-def world_map_with_timeslider(db_path: str = DB_PATH):
-    """Interactive choropleth map with time slider to show evolution."""
+def _animated_choropleth(df: pd.DataFrame, title: str, frame_duration: int = 500) -> Figure:
+    """Build a year-animated choropleth of kg_per_ha with one prebuilt trace per frame.
     
-    con = duckdb.connect(db_path)
-    df = con.execute("""
-    SELECT 
-        iso3,
-        country_name, 
-        region,
-        year,
-        kg_per_ha
-    FROM wb.fertilizer_clean
-    WHERE year >= 1990 AND kg_per_ha IS NOT NULL
-    ORDER BY year, kg_per_ha DESC
-    """).df()
-    con.close()
+    Expects iso3, country_name, region, year and kg_per_ha columns. The color
+    scale is fixed at the 95th percentile so frames stay comparable.
+    """
     
-    fig = px.choropleth(
-        df,
-        locations="iso3",
-        color="kg_per_ha", 
-        hover_name="country_name",
-        hover_data={"region": True, "kg_per_ha": ":.0f", "year": True},
-        animation_frame="year",
-        color_continuous_scale="YlOrRd",
-        range_color=[0, df['kg_per_ha'].quantile(0.95)],  # Fixed scale for comparison
-        title="Evolution of Global Fertilizer Consumption (1990-2020)",
-        projection="natural earth"
+    # Same hover layout px.choropleth emits for an animation_frame of year
+    hovertemplate = (
+        "<b>%{{hovertext}}</b><br><br>"
+        "year={year}<br>"
+        "iso3=%{{location}}<br>"
+        "region=%{{customdata[0]}}<br>"
+        "kg_per_ha=%{{z:.0f}}<extra></extra>"
     )
+    frames = [
+        go.Frame(
+            name=str(year),
+            data=[go.Choropleth(
+                locations=group['iso3'].to_numpy(),
+                z=group['kg_per_ha'].to_numpy(),
+                hovertext=group['country_name'].to_numpy(),
+                customdata=group[['region']].to_numpy(),
+                hovertemplate=hovertemplate.format(year=year),
+                coloraxis="coloraxis"
+            )]
+        )
+        for year, group in df.groupby('year', sort=True)
+    ]
+    
+    def animate_args(frame_names, duration):
+        return [frame_names, {
+            "frame": {"duration": duration, "redraw": True},
+            "mode": "immediate",
+            "fromcurrent": True,
+            "transition": {"duration": duration, "easing": "linear"}
+        }]
     
+    fig = go.Figure(data=frames[0].data if frames else [], frames=frames)
     fig.update_layout(
-        height=600,
+        title=title,
+        coloraxis=dict(
+            colorscale="YlOrRd",
+            cmin=0,
+            cmax=df['kg_per_ha'].quantile(0.95),
+            colorbar=dict(title="kg_per_ha")
+        ),
         geo=dict(
+            projection_type="natural earth",
             showframe=False,
             showcoastlines=True,
         ),
+        updatemenus=[{
+            "type": "buttons",
+            "direction": "left",
+            "showactive": False,
+            "x": 0.1, "xanchor": "right",
+            "y": 0, "yanchor": "top",
+            "pad": {"r": 10, "t": 70},
+            "buttons": [
+                {"label": "&#9654;", "method": "animate", "args": animate_args(None, frame_duration)},
+                {"label": "&#9724;", "method": "animate", "args": animate_args([None], 0)}
+            ]
+        }],
         sliders=[{
+            "active": 0,
             "currentvalue": {"prefix": "Year: "},
-            "pad": {"t": 50}
+            "pad": {"b": 10, "t": 50},
+            "x": 0.1, "xanchor": "left",
+            "y": 0, "yanchor": "top",
+            "len": 0.9,
+            "steps": [
+                {"label": frame.name, "method": "animate", "args": animate_args([frame.name], 0)}
+                for frame in frames
+            ]
         }]
     )
+    return fig
+
+
+def world_map_with_timeslider(db_path: str = DB_PATH):
+    """Interactive choropleth map with time slider to show evolution."""
+    
+    con = _cursor(db_path)
+    df = con.execute(_MAP_SQL).df()
     
-    # Speed up animation
-    fig.layout.updatemenus[0].buttons[0].args[1]["frame"]["duration"] = 500
+    fig = _animated_choropleth(
+        df,
+        title="Evolution of Global Fertilizer Consumption (1990-2020)",
+        frame_duration=500
+    )
+    fig.update_layout(height=600)
     
     fig.show()
     return df, fig
@@ -502,42 +738,20 @@ def world_map_with_timeslider(db_path: str = DB_PATH):
 def interactive_map_with_trends(db_path: str = DB_PATH):
     """Interactive world map with trend chart that updates when countries are clicked."""
     
-    con = duckdb.connect(db_path)
+    con = _cursor(db_path)
     
     # Get data for the map (latest year)
-    map_df = con.execute("""
-    SELECT 
-        iso3,
-        country_name,
-        region,
-        year,
-        kg_per_ha
-    FROM wb.fertilizer_clean
-    WHERE year >= 1990 AND kg_per_ha IS NOT NULL
-    ORDER BY year, kg_per_ha DESC
-    """).df()
+    map_df = con.execute(_MAP_SQL).df()
     
     # Create the choropleth map with time slider
-    fig_map = px.choropleth(
+    fig_map = _animated_choropleth(
         map_df,
-        locations="iso3",
-        color="kg_per_ha", 
-        hover_name="country_name",
-        hover_data={"region": True, "kg_per_ha": ":.0f", "year": True},
-        animation_frame="year",
-        color_continuous_scale="YlOrRd",
-        range_color=[0, map_df['kg_per_ha'].quantile(0.95)],
-        title="🌍 Global Fertilizer Consumption - Click any country to see its trend",
-        projection="natural earth"
+        title="🌍 Global Fertilizer Consumption - Click any country to see its trend"
     )
     
     # Customize the map
     fig_map.update_layout(
         height=500,
-        geo=dict(
-            showframe=False,
-            showcoastlines=True,
-        ),
         coloraxis_colorbar=dict(title="kg/ha")
     )
     
@@ -571,36 +785,15 @@ def interactive_map_with_trends(db_path: str = DB_PATH):
 def get_country_trend(db_path: str = DB_PATH, country_iso3: str = None, country_name: str = None):
     """Get trend data for a specific country to display when clicked."""
     
-    con = duckdb.connect(db_path)
+    con = _cursor(db_path)
     
     if country_iso3:
-        df = con.execute("""
-        SELECT 
-            country_name,
-            year,
-            kg_per_ha,
-            region
-        FROM wb.fertilizer_clean
-        WHERE iso3 = ? AND kg_per_ha IS NOT NULL
-        ORDER BY year
-        """, [country_iso3]).df()
+        df = con.execute(_COUNTRY_TREND_BY_ISO3_SQL, [country_iso3]).df()
     elif country_name:
-        df = con.execute("""
-        SELECT 
-            country_name,
-            year,
-            kg_per_ha,
-            region
-        FROM wb.fertilizer_clean
-        WHERE country_name = ? AND kg_per_ha IS NOT NULL
-        ORDER BY year
-        """, [country_name]).df()
+        df = con.execute(_COUNTRY_TREND_BY_NAME_SQL, [country_name]).df()
     else:
-        con.close()
         return None
     
-    con.close()
-    
     if df.empty:
         return None
     
@@ -611,9 +804,9 @@ def get_country_trend(db_path: str = DB_PATH, country_iso3: str = None, country_
     fig = go.Figure()
     
     # Main trend line
-    fig.add_trace(go.Scatter(
-        x=df['year'],
-        y=df['kg_per_ha'],
+    fig.add_trace(go.Scattergl(
+        x=df['year'].to_numpy(np.int32),
+        y=df['kg_per_ha'].to_numpy(np.float32),
         mode='lines+markers',
         name=country_name,
         line=dict(width=3, color='red'),
@@ -660,4 +853,9 @@ def get_country_trend(db_path: str = DB_PATH, country_iso3: str = None, country_
 # for iso3 in example_countries:
 #     result = get_country_trend(country_iso3=iso3)
 #     if result is not None:
-#         print(f"✓ Loaded trend for {iso3}")
\ No newline at end of file
+#         print(f"✓ Loaded trend for {iso3}")
+
+
+if __name__ == "__main__":
+    ensure_data()
+    verify_data()